@@ -1,73 +1,123 @@
 """Data storage and management for detection results."""
 
+import binascii
 import threading
-from typing import Dict, List, Optional
+from collections import deque
+from typing import Dict, List, Optional, Tuple
 import time
 
+try:
+    # SIMD (SSSE3/AVX2/NEON) base64 codec with the same API as the stdlib module
+    import pybase64 as base64
+except ImportError:
+    import base64
+
 
 class DataStorage:
     def __init__(self):
+        # Only writers take the lock; readers go through the snapshot
+        # references below, which are swapped atomically under the GIL.
         self._lock = threading.Lock()
-        self._latest_data = {}
-        self._latest_raw_data = {}  # Separate storage for raw images
-        self._detection_history = []
-        self._raw_history = []
+        # Each ref is a (metadata, jpeg_bytes) pair so both swap together
+        self._latest_ref = ({}, None)
+        self._latest_raw_ref = ({}, None)  # Separate storage for raw images
         self._max_history = 100
+        # Bounded deques evict the oldest entry in O(1) on append
+        self._detection_history = deque(maxlen=self._max_history)
+        self._raw_history = deque(maxlen=self._max_history)
+        # Bumped on every change so readers can tell if anything is new
+        self._version = 0
+        # Set (and replaced) on every change to wake push subscribers
+        self._update_event = threading.Event()
+
+    def _notify_update(self):
+        """Bump the version and wake everyone waiting on the update event."""
+        self._version += 1
+        event, self._update_event = self._update_event, threading.Event()
+        event.set()
+
+    def get_version(self) -> int:
+        """Get the data version (incremented on every store/clear)."""
+        return self._version
+
+    def get_update_event(self) -> threading.Event:
+        """Get the event that will be set on the next data change.
+
+        Grab it before reading the latest data so no update is missed.
+        """
+        return self._update_event
+
+    def store_data(self, data: Dict, image_bytes: Optional[bytes] = None):
+        """Store the latest detection data.
+
+        The image is kept as raw JPEG bytes, separate from the metadata. If
+        ``image_bytes`` is not given, a base64 ``image`` field is decoded once here.
+        """
+        # Build a fresh snapshot instead of mutating one readers may hold
+        snapshot = {k: v for k, v in data.items() if k != 'image'}
+        snapshot['timestamp'] = time.time()
+
+        if image_bytes is None and isinstance(data.get('image'), str):
+            try:
+                image_bytes = base64.b64decode(data['image'], validate=False)
+            except (binascii.Error, ValueError) as e:
+                print(f"Invalid base64 image in payload: {e}")
 
-    def store_data(self, data: Dict):
-        """Store the latest detection data."""
         with self._lock:
-            data['timestamp'] = time.time()
-            
+            # Version this snapshot will publish, so clients can skip unchanged frames
+            snapshot['version'] = self._version + 1
+
             # Check if it's a raw image
-            if data.get('raw_image', False):
-                self._latest_raw_data = data
-                self._raw_history.append(data)
-                
-                # Keep only recent raw history
-                if len(self._raw_history) > self._max_history:
-                    self._raw_history.pop(0)
+            if snapshot.get('raw_image', False):
+                self._raw_history.append(snapshot)
+                self._latest_raw_ref = (snapshot, image_bytes)
             else:
                 # Normal processed data
-                self._latest_data = data
-                self._detection_history.append(data)
-                
-                # Keep only recent history
-                if len(self._detection_history) > self._max_history:
-                    self._detection_history.pop(0)
+                self._detection_history.append(snapshot)
+                self._latest_ref = (snapshot, image_bytes)
+            self._notify_update()
 
     def get_latest_data(self) -> Dict:
-        """Get the most recent detection data."""
-        with self._lock:
-            return self._latest_data.copy()
-    
+        """Get the most recent detection metadata (without the image).
+
+        The returned dict is a shared snapshot and must be treated as read-only.
+        """
+        return self._latest_ref[0]
+
     def get_latest_raw_data(self) -> Dict:
-        """Get the most recent raw image data."""
-        with self._lock:
-            return self._latest_raw_data.copy()
+        """Get the most recent raw image metadata (read-only snapshot)."""
+        return self._latest_raw_ref[0]
+
+    def get_latest_image(self, raw: bool = False) -> Optional[bytes]:
+        """Get the JPEG bytes of the most recent processed (or raw) image."""
+        return (self._latest_raw_ref if raw else self._latest_ref)[1]
+
+    def get_latest_with_image(self, raw: bool = False) -> Tuple[Dict, Optional[bytes]]:
+        """Get metadata and JPEG bytes from the same snapshot."""
+        return self._latest_raw_ref if raw else self._latest_ref
 
     def get_detection_count(self) -> int:
         """Get the number of detections in latest data."""
-        with self._lock:
-            return len(self._latest_data.get('detections', []))
+        return len(self._latest_ref[0].get('detections', []))
 
     def get_history(self) -> List[Dict]:
         """Get detection history."""
         with self._lock:
-            return self._detection_history.copy()
-    
+            return list(self._detection_history)
+
     def get_raw_history(self) -> List[Dict]:
         """Get raw image history."""
         with self._lock:
-            return self._raw_history.copy()
+            return list(self._raw_history)
 
     def clear_data(self):
         """Clear all stored data."""
         with self._lock:
-            self._latest_data = {}
-            self._latest_raw_data = {}
-            self._detection_history = []
-            self._raw_history = []
+            self._latest_ref = ({}, None)
+            self._latest_raw_ref = ({}, None)
+            self._detection_history.clear()
+            self._raw_history.clear()
+            self._notify_update()
 
 
 # Global data storage instance
@@ -1,8 +1,11 @@
 # Flask server pentru primirea datelor de detectie si servirea catre Streamlit
 # Creat pentru integrarea cu robotic arm prin BLE
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import asyncio
+import base64
+import concurrent.futures
+import json
 import sys
 import os
 import threading
@@ -38,6 +41,9 @@ except Exception as e:
     FLASK_HOST = '0.0.0.0'
     FLASK_PORT = 5001
 
+# Cat de des trimit un keepalive pe /events cand nu vin date noi (secunde)
+SSE_KEEPALIVE = 15
+
 def strip_image_data_for_log(payload):
     # Curăță payload-ul de date mari pentru logging decent
     # Clonam obiectul ca sa nu stricam originalul
@@ -57,60 +63,124 @@ def strip_image_data_for_log(payload):
     return clean_data
 
 
+def detection_fingerprint(payload):
+    # Amprenta ieftina a detectiilor ca sa nu retrimit prin BLE aceleasi comenzi
+    return hash((
+        tuple(payload.get('crop_shape') or ()),
+        tuple((det.get('class'), tuple(det.get('center_px', ())))
+              for det in payload.get('detections', []))
+    ))
+
+
 class FlaskServer:
     def __init__(self):
         self.app = Flask(__name__)
         # Încerc să inițializez BLE handler-ul dacă există
         self.ble_handler = BLEHandler() if BLEHandler else None
+        # Amprenta ultimelor detectii trimise/puse in coada pentru BLE (conteaza doar
+        # cat timp bratul inca le executa sau le are in coada)
+        self._last_fp = None
+        # Un singur event loop pentru toate request-urile, in loc de asyncio.run per POST
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
         self._setup_routes()
         print("Flask server ready")
 
+    def dispatch_ble(self, payload):
+        # Sar peste detectii identice cu comanda care inca se executa / asteapta in coada.
+        # Dupa ce bratul termina, aceeasi comanda (ex. obiect nou pe acelasi loc) pleaca iar
+        fp = detection_fingerprint(payload)
+        if fp == self._last_fp:
+            ble_status = self.ble_handler.get_status()
+            if not ble_status['arm_idle'] or ble_status['has_queued_payload']:
+                return 'duplicate_skipped'
+
+        future = asyncio.run_coroutine_threadsafe(self.ble_handler.send_data(payload), self._loop)
+        try:
+            status = future.result(timeout=5)
+        except concurrent.futures.TimeoutError:
+            # Cadrul e deja salvat - nu transform request-ul intr-un 500
+            future.cancel()
+            return 'ble_timeout'
+        # Tin minte amprenta doar daca payload-ul chiar a plecat sau e in coada
+        if status in ('sent_immediately', 'queued'):
+            self._last_fp = fp
+        return status
+
     def _setup_routes(self):
         # Setup pentru toate rutele Flask
         
         @self.app.route('/data', methods=['POST'])
         def receive_data():
             try:
-                # Verific daca primesc JSON
-                if not request.is_json:
-                    return jsonify({'error': 'Trebuie sa fie JSON'}), 415
-
-                payload = request.get_json()
-                
-                # Verific daca e raw image
-                is_raw_image = payload.get('raw_image', False)
-                
-                # Curăț logging-ul - scap de datele mari
-                clean_payload = strip_image_data_for_log(payload)
-                
-                # Log diferit pentru raw vs processed
-                if is_raw_image:
-                    print(f"📸 RAW image primit: {clean_payload.get('crop_shape', 'unknown size')}")
+                # Accept JSON (imagine base64) sau multipart (JPEG brut + metadate JSON).
+                # Multipart poate aduce un batch: meta e lista, imaginile sunt image_0..image_{n-1}
+                if request.is_json:
+                    frames = [(request.get_json(), None)]
+                elif request.mimetype == 'multipart/form-data':
+                    meta = request.form.get('meta')
+                    if meta is None and 'meta' in request.files:
+                        meta = request.files['meta'].read()
+                    if meta is None:
+                        return jsonify({'error': 'Lipseste partea meta'}), 400
+                    meta = json.loads(meta)
+                    if isinstance(meta, list):
+                        frames = []
+                        for i, payload in enumerate(meta):
+                            image_file = request.files.get(f'image_{i}')
+                            frames.append((payload, image_file.read() if image_file else None))
+                    else:
+                        image_file = request.files.get('image')
+                        frames = [(meta, image_file.read() if image_file else None)]
                 else:
-                    detection_count = len(payload.get('detections', []))
-                    print(f"🎯 PROCESSED image primit cu {detection_count} detectii")
+                    return jsonify({'error': 'Trebuie sa fie JSON sau multipart'}), 415
                 
-                # Salvez datele pentru Streamlit
-                if data_store:
-                    data_store.store_data(payload)
+                if not frames:
+                    return jsonify({'error': 'Batch gol'}), 400
                 
-                # Pentru raw images, nu trimit prin BLE (nu are sens sa procesez)
-                if is_raw_image:
-                    print("📸 Raw image - nu trimit prin BLE")
-                    status = 'raw_image_received'
-                else:
-                    # Trimit prin BLE doar pentru imagini procesate cu detectii
-                    if self.ble_handler:
-                        status = asyncio.run(self.ble_handler.send_data(payload))
-                        print(f"BLE: {status}")
+                # Din batch trimit prin BLE doar cel mai nou cadru procesat - restul sunt deja vechi
+                last_processed = max((i for i, (payload, _) in enumerate(frames)
+                                      if not payload.get('raw_image', False)), default=None)
+                
+                for i, (payload, image_bytes) in enumerate(frames):
+                    # Verific daca e raw image
+                    is_raw_image = payload.get('raw_image', False)
+                    
+                    # Curăț logging-ul - scap de datele mari
+                    clean_payload = strip_image_data_for_log(payload)
+                    
+                    # Log diferit pentru raw vs processed
+                    if is_raw_image:
+                        print(f"📸 RAW image primit: {clean_payload.get('crop_shape', 'unknown size')}")
                     else:
-                        print("BLE nu e disponibil")
-                        status = 'no_ble'
+                        detection_count = len(payload.get('detections', []))
+                        print(f"🎯 PROCESSED image primit cu {detection_count} detectii")
+                    
+                    # Salvez datele pentru Streamlit
+                    if data_store:
+                        data_store.store_data(payload, image_bytes)
+                    
+                    # Pentru raw images, nu trimit prin BLE (nu are sens sa procesez)
+                    if is_raw_image:
+                        print("📸 Raw image - nu trimit prin BLE")
+                        status = 'raw_image_received'
+                    elif i != last_processed:
+                        status = 'superseded_in_batch'
+                    else:
+                        # Trimit prin BLE doar pentru imagini procesate cu detectii
+                        if self.ble_handler:
+                            status = self.dispatch_ble(payload)
+                            print(f"BLE: {status}")
+                        else:
+                            print("BLE nu e disponibil")
+                            status = 'no_ble'
                 
+                # Raspunsul descrie ultimul cadru din batch
                 return jsonify({
                     'status': status, 
                     'received_count': len(payload.get('detections', [])),
-                    'is_raw': is_raw_image
+                    'is_raw': is_raw_image,
+                    'batch_size': len(frames)
                 }), 200
             except Exception as e:
                 print(f"Eroare in receive_data: {e}")
@@ -131,12 +201,33 @@ class FlaskServer:
                 print(f"Eroare in check_ready: {e}")
                 return jsonify({'error': str(e)}), 500
 
+        def with_base64_image(meta, image_bytes):
+            # Format vechi (imagine base64 in JSON) pentru clientii care inca il folosesc
+            if not image_bytes:
+                return meta
+            return {**meta, 'image': base64.b64encode(image_bytes).decode('ascii')}
+
+        def jpeg_response(raw, missing_msg):
+            # Meta si JPEG din acelasi snapshot, ca versiunea din header sa fie a imaginii.
+            # Cu ?version=N dau 409 daca intre timp a venit alt cadru (detectiile N nu se
+            # potrivesc pe cadrul N+k)
+            meta, image_bytes = data_store.get_latest_with_image(raw=raw) if data_store else ({}, None)
+            if not image_bytes:
+                return jsonify({'error': missing_msg}), 404
+            version = meta.get('version')
+            wanted = request.args.get('version', type=int)
+            if wanted is not None and wanted != version:
+                return jsonify({'error': 'Cadrul cerut a fost inlocuit', 'version': version}), 409
+            response = Response(image_bytes, mimetype='image/jpeg')
+            response.headers['X-Frame-Version'] = str(version)
+            return response
+
         @self.app.route('/get', methods=['GET'])
         def get_data():
-            # Pentru Streamlit sa poata lua datele
+            # Pentru Streamlit sa poata lua datele (format vechi, cu imaginea in JSON)
             try:
                 if data_store:
-                    latest_data = data_store.get_latest_data()
+                    latest_data = with_base64_image(*data_store.get_latest_with_image())
                 else:
                     latest_data = {'detections': [], 'message': 'Nu am data store'}
                 return jsonify(latest_data)
@@ -144,37 +235,109 @@ class FlaskServer:
                 print(f"Eroare in get_data: {e}")
                 return jsonify({'error': str(e)}), 500
 
+        @self.app.route('/get/meta', methods=['GET'])
+        def get_meta():
+            # Doar metadatele (detectii, timestamp) - imaginea se ia de pe /get/image
+            try:
+                if data_store:
+                    return jsonify(data_store.get_latest_data())
+                return jsonify({'detections': [], 'message': 'Nu am data store'})
+            except Exception as e:
+                print(f"Eroare in get_meta: {e}")
+                return jsonify({'error': str(e)}), 500
+
+        @self.app.route('/get/image', methods=['GET'])
+        def get_image():
+            # Imaginea procesata ca JPEG, fara base64
+            return jpeg_response(False, 'Nu am imagine')
+
         @self.app.route('/get_raw', methods=['GET'])
         def get_raw_data():
-            # Pentru Streamlit sa poata lua raw images
+            # Pentru Streamlit sa poata lua raw images (format vechi, cu imaginea in JSON)
             try:
                 if data_store:
-                    latest_raw_data = data_store.get_latest_raw_data()
+                    latest_raw_data, image_bytes = data_store.get_latest_with_image(raw=True)
                     if not latest_raw_data:
                         return jsonify({'message': 'Nu am raw images', 'raw_image': False})
-                    return jsonify(latest_raw_data)
+                    return jsonify(with_base64_image(latest_raw_data, image_bytes))
                 else:
                     return jsonify({'error': 'Nu am data store', 'raw_image': False}), 500
             except Exception as e:
                 print(f"Eroare in get_raw_data: {e}")
                 return jsonify({'error': str(e)}), 500
 
+        @self.app.route('/get_raw/meta', methods=['GET'])
+        def get_raw_meta():
+            # Metadatele ultimei imagini raw
+            try:
+                if data_store:
+                    latest_raw_data = data_store.get_latest_raw_data()
+                    if not latest_raw_data:
+                        return jsonify({'message': 'Nu am raw images', 'raw_image': False})
+                    return jsonify(latest_raw_data)
+                return jsonify({'error': 'Nu am data store', 'raw_image': False}), 500
+            except Exception as e:
+                print(f"Eroare in get_raw_meta: {e}")
+                return jsonify({'error': str(e)}), 500
+
+        @self.app.route('/get_raw/image', methods=['GET'])
+        def get_raw_image():
+            # Ultima imagine raw ca JPEG
+            return jpeg_response(True, 'Nu am raw images')
+
+        @self.app.route('/events', methods=['GET'])
+        def stream_events():
+            # Push (SSE) pentru Streamlit - trimit datele doar cand se schimba
+            if not data_store:
+                return jsonify({'error': 'Nu am data store'}), 500
+
+            def event_stream():
+                sent = {'processed': None, 'raw': None}
+                while True:
+                    # Iau event-ul inainte sa citesc datele ca sa nu pierd un update
+                    update = data_store.get_update_event()
+                    latest = {
+                        'processed': data_store.get_latest_data(),
+                        'raw': data_store.get_latest_raw_data(),
+                    }
+                    for kind, snapshot in latest.items():
+                        if snapshot and snapshot is not sent[kind]:
+                            sent[kind] = snapshot
+                            yield f"event: {kind}\ndata: {json.dumps(snapshot)}\n\n"
+                    if not update.wait(timeout=SSE_KEEPALIVE):
+                        yield ": keepalive\n\n"
+
+            return Response(event_stream(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
+
+        # Cache pentru /status - il refac doar cand se schimba datele sau BLE-ul
+        # (key, body) intr-un singur tuplu ca sa se schimbe atomic intre thread-uri
+        status_cache = [(None, None)]
+
         @self.app.route('/status', methods=['GET'])
         def get_status():
             # Status general al serverului
             try:
+                ble_status = {}
+                if self.ble_handler:
+                    ble_status = self.ble_handler.get_status()
+
+                version = data_store.get_version() if data_store else 0
+                key = (version, tuple(ble_status.items()))
+                cached_key, cached_body = status_cache[0]
+                if key == cached_key:
+                    return Response(cached_body, mimetype='application/json')
+
                 if data_store:
-                    detection_count = data_store.get_detection_count()
-                    timestamp = data_store.get_latest_data().get('timestamp', 0)
+                    # Un singur snapshot ca numarul si timestamp-ul sa fie consistente
+                    latest = data_store.get_latest_data()
+                    detection_count = len(latest.get('detections', []))
+                    timestamp = latest.get('timestamp', 0)
                 else:
                     detection_count = 0
                     timestamp = 0
-                
-                ble_status = {}
-                if self.ble_handler:
-                    ble_status = self.ble_handler.get_status()
                     
-                return jsonify({
+                body = json.dumps({
                     'status': 'running',
                     'detection_count': detection_count,
                     'timestamp': timestamp,
@@ -182,6 +345,8 @@ class FlaskServer:
                     'ble_status': ble_status,
                     'data_store_available': data_store is not None
                 })
+                status_cache[0] = (key, body)
+                return Response(body, mimetype='application/json')
             except Exception as e:
                 print(f"Eroare in get_status: {e}")
                 return jsonify({'error': str(e)}), 500
@@ -190,6 +355,8 @@ class FlaskServer:
         def clear_data():
             # Golesc datele stocate
             try:
+                # Dupa clear, prima comanda trimisa nu mai e "duplicat"
+                self._last_fp = None
                 if data_store:
                     data_store.clear_data()
                     return jsonify({'status': 'cleared'})
@@ -1,12 +1,35 @@
 """Image processing utilities for Streamlit UI."""
 
-import base64
+try:
+    import pybase64 as base64  # drop-in, SIMD-accelerated
+except ImportError:
+    import base64
+
 import numpy as np
 import cv2
 from typing import Optional, Tuple, List, Dict
 
+try:
+    # libjpeg-turbo decodes straight to RGB, skipping the separate cvtColor pass
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo_jpeg = TurboJPEG()
+except Exception:  # Missing package or native library
+    _turbo_jpeg = None
+
+JPEG_MAGIC = b'\xff\xd8'
+
+# Annotation style used by draw_detections
+LABEL_FONT = cv2.FONT_HERSHEY_SIMPLEX
+LABEL_SCALE = 0.5
+LABEL_THICKNESS = 2
+ANNOTATION_COLOR = (0, 255, 0)
+
 
 class ImageProcessor:
+    # One cached (key, image, status) slot per image kind (raw / processed),
+    # so re-rendering an unchanged frame skips the decode entirely
+    _frame_cache: Dict[bool, Tuple] = {}
+
     @staticmethod
     def decode_base64_image(img_b64: str) -> Optional[np.ndarray]:
         """Decode base64 image to numpy array."""
@@ -15,50 +38,114 @@ class ImageProcessor:
             return None
         
         try:
-            img_data = base64.b64decode(img_b64)
+            img_data = base64.b64decode(img_b64, validate=False)
+        except Exception as e:
+            print(f"Error decoding image: {e}")
+            return None
+        return ImageProcessor.decode_image_bytes(img_data)
+
+    @staticmethod
+    def decode_image_bytes(img_data: bytes) -> Optional[np.ndarray]:
+        """Decode encoded (JPEG/PNG) image bytes to an RGB numpy array."""
+        if not img_data:
+            return None
+
+        if _turbo_jpeg is not None and img_data[:2] == JPEG_MAGIC:
+            try:
+                return _turbo_jpeg.decode(img_data, pixel_format=TJPF_RGB)
+            except Exception as e:
+                print(f"TurboJPEG decode failed, falling back to OpenCV: {e}")
+
+        try:
             img_array = np.frombuffer(img_data, dtype=np.uint8)
             img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
             if img is None:
                 print("Failed to decode image from buffer")
                 return None
-            return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+            # imdecode's buffer is ours, so convert in place instead of allocating
+            return cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=img)
         except Exception as e:
             print(f"Error decoding image: {e}")
             return None
 
     @staticmethod
     def draw_detections(img: np.ndarray, detections: List[Dict]) -> np.ndarray:
-        """Draw detection annotations on image."""
-        img_copy = img.copy()
+        """Draw detection annotations on image, in place.
+
+        The caller owns ``img``; pass a copy if the original must be kept.
+        """
+        dets = [det for det in detections if 'center_px' in det]
+        if not dets:
+            return img
         
-        for det in detections:
-            if 'center_px' in det:
-                x, y = map(int, det['center_px'])
-                y = img.shape[0] - y  # Flip Y coordinate
-                
-                # Draw circle
-                cv2.circle(img_copy, (x, y), 5, (0, 255, 0), -1)
-                
-                # Draw label
-                label = f"{det.get('class', '')} ({det.get('confidence', 0):.2f})"
-                cv2.putText(img_copy, label, (x + 10, y),
-                           cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 2)
+        # All centers at once: truncate to int and flip Y in one vectorized pass
+        centers = np.array([det['center_px'] for det in dets], dtype=np.float64).astype(np.int32)
+        centers[:, 1] = img.shape[0] - centers[:, 1]
         
-        return img_copy
+        for det, (x, y) in zip(dets, centers.tolist()):
+            # Draw circle
+            cv2.circle(img, (x, y), 5, ANNOTATION_COLOR, -1)
+            
+            # Draw label
+            label = f"{det.get('class', '')} ({det.get('confidence', 0):.2f})"
+            cv2.putText(img, label, (x + 10, y), LABEL_FONT, LABEL_SCALE, ANNOTATION_COLOR, LABEL_THICKNESS)
+        
+        return img
+
+    @staticmethod
+    def _cache_key(data: Dict, image_bytes: Optional[bytes] = None):
+        """Cache key for a frame: the server's data version, else a payload hash.
+
+        The version restarts at 0 with the Flask server, so it is paired with
+        the timestamp ``store_data`` stamps on the same snapshot.
+        """
+        if data.get("version") is not None:
+            return ("version", data["version"], data.get("timestamp"))
+        payload = image_bytes if image_bytes is not None else data.get("image")
+        return ("hash", hash(payload)) if payload else None
+
+    @staticmethod
+    def get_cached_result(data: Dict) -> Optional[Tuple[np.ndarray, str]]:
+        """Return the rendered frame for ``data`` if its version was already processed."""
+        if data.get("version") is None:
+            return None
+        cached = ImageProcessor._frame_cache.get(bool(data.get("raw_image", False)))
+        if cached and cached[0] == ImageProcessor._cache_key(data):
+            return cached[1], cached[2]
+        return None
 
     @staticmethod
-    def process_detection_data(data: Dict) -> Tuple[Optional[np.ndarray], str]:
-        """Process detection data and return image with status."""
+    def process_detection_data(data: Dict, image_bytes: Optional[bytes] = None) -> Tuple[Optional[np.ndarray], str]:
+        """Process detection data and return image with status.
+
+        The image comes from ``image_bytes`` (JPEG from ``/get/image``) or,
+        for the legacy format, from the base64 ``image`` field. The result is
+        cached, so treat the returned image as read-only.
+        """
+        kind = bool(data.get("raw_image", False))
+        key = ImageProcessor._cache_key(data, image_bytes)
+        cached = ImageProcessor._frame_cache.get(kind)
+        if key is not None and cached and cached[0] == key:
+            return cached[1], cached[2]
+
+        img, status = ImageProcessor._render(data, image_bytes)
+        if key is not None and img is not None:
+            ImageProcessor._frame_cache[kind] = (key, img, status)
+        return img, status
+
+    @staticmethod
+    def _render(data: Dict, image_bytes: Optional[bytes] = None) -> Tuple[Optional[np.ndarray], str]:
+        """Decode the frame and draw its detections (uncached)."""
         detections = data.get("detections", [])
         is_raw_image = data.get("raw_image", False)
         
-        # Get the image data (always in "image" field)
-        img_b64 = data.get("image")
-        if not img_b64:
-            return None, "No image data available"
-        
         # Decode the image
-        img = ImageProcessor.decode_base64_image(img_b64)
+        if image_bytes is not None:
+            img = ImageProcessor.decode_image_bytes(image_bytes)
+        elif data.get("image"):
+            img = ImageProcessor.decode_base64_image(data["image"])
+        else:
+            return None, "No image data available"
         if img is None:
             return None, "Failed to decode image"
         
@@ -68,8 +155,9 @@ class ImageProcessor:
         
         # If we have detections, show image with annotations
         if detections:
-            img_with_detections = ImageProcessor.draw_detections(img, detections)
-            return img_with_detections, f"Detections: {len(detections)}"
+            # The decoded frame is private to this call, so draw straight onto it
+            ImageProcessor.draw_detections(img, detections)
+            return img, f"Detections: {len(detections)}"
         
         # If processed image but no detections, return plain image
         return img, "No detections found"
@@ -3,17 +3,23 @@
 import streamlit as st
 import requests
 import time
-from threading import Thread
+import json
 import sys
 import os
-import base64
 
 # Ensure we can import local modules
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, current_dir)
 
 from image_utils import ImageProcessor
-from config import FLASK_PORT
+from config import FLASK_PORT, CLASS_ID
+
+# Stop the live view after this long (prevents an endless script run)
+LIVE_VIEW_SECONDS = 100
+# Read timeout for the event stream; the server sends keepalives more often than this
+EVENT_STREAM_TIMEOUT = 30
+# Returned by fetch_image when a newer frame replaced the requested version
+STALE_IMAGE = object()
 
 
 class StreamlitUI:
@@ -53,12 +59,12 @@ class StreamlitUI:
             st.info("💡 Make sure the Flask server is running on port 5001")
 
     def fetch_detection_data(self):
-        """Fetch latest detection data from Flask server."""
+        """Fetch latest detection metadata from Flask server."""
         if not self.server_running:
             return {}
             
         try:
-            response = requests.get(f"{self.flask_url}/get", timeout=3)
+            response = requests.get(f"{self.flask_url}/get/meta", timeout=3)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.ConnectionError:
@@ -73,12 +79,12 @@ class StreamlitUI:
             return {}
 
     def fetch_raw_data(self):
-        """Fetch latest raw image data from Flask server."""
+        """Fetch latest raw image metadata from Flask server."""
         if not self.server_running:
             return {}
             
         try:
-            response = requests.get(f"{self.flask_url}/get_raw", timeout=3)
+            response = requests.get(f"{self.flask_url}/get_raw/meta", timeout=3)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.ConnectionError:
@@ -92,6 +98,100 @@ class StreamlitUI:
             st.error(f"❌ Error fetching raw data: {e}")
             return {}
 
+    def fetch_image(self, raw=False, version=None):
+        """Fetch the latest processed (or raw) image as JPEG bytes.
+
+        With ``version``, only the image from that data version is accepted;
+        if a newer frame already replaced it, ``STALE_IMAGE`` is returned.
+        """
+        if not self.server_running:
+            return None
+            
+        endpoint = "/get_raw/image" if raw else "/get/image"
+        params = {"version": version} if version is not None else None
+        try:
+            response = requests.get(f"{self.flask_url}{endpoint}", params=params, timeout=3)
+            if response.status_code == 409:
+                return STALE_IMAGE
+            if response.status_code != 200:
+                return None
+            return response.content
+        except requests.exceptions.RequestException:
+            return None
+
+    def stream_events(self, deadline=None):
+        """Yield (kind, data) pairs pushed by the Flask server over SSE.
+
+        Stops once ``time.monotonic()`` passes ``deadline``; keepalive lines
+        let this be checked even while no data is pushed.
+        """
+        with requests.get(f"{self.flask_url}/events", stream=True,
+                          timeout=(3, EVENT_STREAM_TIMEOUT)) as response:
+            response.raise_for_status()
+            kind = "message"
+            for line in response.iter_lines(decode_unicode=True):
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+                if not line:
+                    # Blank line ends the event
+                    kind = "message"
+                elif line.startswith("event:"):
+                    kind = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    yield kind, json.loads(line[len("data:"):])
+
+    def show_processed(self, data, placeholder, status, retry=True):
+        """Render a processed frame with its detections.
+
+        If a newer frame replaced ``data`` before its image was fetched, the
+        metadata is fetched again once and that frame is shown instead.
+        """
+        if not data or not data.get('detections'):
+            placeholder.info("📷 Waiting for detection data...")
+            status.info("⏳ No detections available")
+            return
+
+        # Same version as last render: reuse it without fetching the image again
+        cached = self.image_processor.get_cached_result(data)
+        if cached:
+            img, status_msg = cached
+        else:
+            # Ask for the image of this exact version, so detections never get
+            # drawn (and cached) on a newer frame
+            image_bytes = self.fetch_image(version=data.get('version'))
+            if image_bytes is STALE_IMAGE:
+                if retry:
+                    self.show_processed(self.fetch_detection_data(), placeholder, status, retry=False)
+                else:
+                    status.info("🔄 Frame was replaced by a newer one while loading")
+                return
+            img, status_msg = self.image_processor.process_detection_data(data, image_bytes)
+        if img is not None:
+            placeholder.image(img, caption="Latest Detection", use_container_width=True)
+            status.success(f"📊 {status_msg}")
+            self.display_detection_info(data)
+        else:
+            placeholder.info("📷 Waiting for processed image data...")
+            status.info("⏳ No processed images")
+
+    def show_raw(self, data, placeholder, status):
+        """Render a raw camera frame."""
+        if not data or not data.get('raw_image', False):
+            placeholder.info("📷 Waiting for raw images...")
+            status.info("⏳ Switch Pi to raw mode to see images here")
+            return
+
+        # Raw frames need no drawing, so the JPEG goes to st.image undecoded.
+        # No version check: with no detections to match, the newest frame is fine
+        img_bytes = self.fetch_image(raw=True)
+        if img_bytes:
+            placeholder.image(img_bytes, caption="Raw Camera Feed", use_container_width=True)
+            status.success("📸 Raw camera image")
+            self.display_detection_info(data)
+        else:
+            placeholder.info("📷 No raw image data...")
+            status.info("⏳ No raw images")
+
     def display_server_status(self):
         """Display server status in sidebar."""
         with st.sidebar:
@@ -200,7 +300,6 @@ class StreamlitUI:
                             
                             # Show class mapping
                             class_name = det.get('class', 'Unknown')
-                            from config import CLASS_ID
                             class_id = CLASS_ID.get(class_name, 'Unknown')
                             st.write(f"**Class ID:** {class_id}")
                 
@@ -227,15 +326,12 @@ class StreamlitUI:
         """Display control panel."""
         st.header("🎛️ Controls")
         
-        col1, col2, col3, col4 = st.columns(4)
+        col1, col2, col3 = st.columns(3)
         
         with col1:
-            auto_refresh = st.checkbox("Auto Refresh", value=False)
+            auto_refresh = st.checkbox("Live Updates", value=False)
         
         with col2:
-            refresh_rate = st.slider("Refresh Rate (s)", 0.5, 5.0, 1.0)
-        
-        with col3:
             if st.button("🗑️ Clear Data"):
                 if self.server_running:
                     try:
@@ -248,11 +344,11 @@ class StreamlitUI:
                 else:
                     st.error("❌ Server not connected")
         
-        with col4:
+        with col3:
             if st.button("🔄 Refresh Now"):
                 st.rerun()
         
-        return auto_refresh, refresh_rate
+        return auto_refresh
 
     def run(self):
         """Run the Streamlit application."""
@@ -265,7 +361,7 @@ class StreamlitUI:
         self.display_server_status()
         
         # Control panel
-        auto_refresh, refresh_rate = self.display_controls()
+        auto_refresh = self.display_controls()
         
         # Main content area
         st.header("📷 Detection Display")
@@ -283,104 +379,38 @@ class StreamlitUI:
             raw_placeholder = st.empty()
             raw_status = st.empty()
         
-        # Manual refresh or auto-refresh
+        # Manual refresh or live updates pushed by the server
         if auto_refresh and self.server_running:
-            st.info("🔄 Auto-refresh enabled")
+            st.info("🔄 Live updates enabled")
             
-            # Create a placeholder for refresh counter
+            # Create a placeholder for update counter
             refresh_counter = st.empty()
             
-            # Auto-refresh loop
-            for i in range(100):  # Limit to prevent infinite loop
-                # Fetch both processed and raw data
-                processed_data = self.fetch_detection_data()
-                raw_data = self.fetch_raw_data()
-                
-                # Display processed images
-                if processed_data and processed_data.get('detections'):
-                    img, status = self.image_processor.process_detection_data(processed_data)
-                    if img is not None:
-                        processed_placeholder.image(
-                            img, 
-                            caption="Latest Detection", 
-                            use_container_width=True
-                        )
-                        processed_status.success(f"📊 {status}")
-                        # Display detection info in sidebar
-                        self.display_detection_info(processed_data)
-                    else:
-                        processed_placeholder.info("📷 Waiting for processed image data...")
-                        processed_status.info("⏳ No processed images")
-                else:
-                    processed_placeholder.info("� Waiting for detection data...")
-                    processed_status.info("⏳ No detections available")
-                
-                # Display raw images
-                if raw_data and raw_data.get('raw_image', False):
-                    raw_img, raw_status_msg = self.image_processor.process_detection_data(raw_data)
-                    if raw_img is not None:
-                        raw_placeholder.image(
-                            raw_img, 
-                            caption="Raw Camera Feed", 
-                            use_container_width=True
-                        )
-                        raw_status.success(f"📸 {raw_status_msg}")
-                        # Display raw info in sidebar when we have raw data
-                        self.display_detection_info(raw_data)
+            # Until the server pushes something, show the waiting state
+            self.show_processed({}, processed_placeholder, processed_status)
+            self.show_raw({}, raw_placeholder, raw_status)
+            
+            # The server sends the current state first, then only changes
+            deadline = time.monotonic() + LIVE_VIEW_SECONDS
+            try:
+                for i, (kind, data) in enumerate(self.stream_events(deadline)):
+                    if kind == 'raw':
+                        self.show_raw(data, raw_placeholder, raw_status)
                     else:
-                        raw_placeholder.info("📷 No raw image data...")
-                        raw_status.info("⏳ No raw images")
-                else:
-                    raw_placeholder.info("📷 Waiting for raw images...")
-                    raw_status.info("⏳ Switch Pi to raw mode to see images here")
-                
-                # Show refresh counter
-                refresh_counter.text(f"🔄 Refresh #{i+1} - Next in {refresh_rate}s")
-                
-                time.sleep(refresh_rate)
+                        self.show_processed(data, processed_placeholder, processed_status)
+                    
+                    refresh_counter.text(f"🔄 Update #{i+1} ({kind})")
+                refresh_counter.info(
+                    f"⏹️ Live view stopped after {LIVE_VIEW_SECONDS}s - press Refresh Now to resume"
+                )
+            except requests.exceptions.RequestException as e:
+                st.warning(f"🔄 Live update stream interrupted: {e}")
         else:
             # Manual refresh mode
             if self.server_running:
                 # Fetch both types of data
-                processed_data = self.fetch_detection_data()
-                raw_data = self.fetch_raw_data()
-                
-                # Display processed images
-                if processed_data and processed_data.get('detections'):
-                    img, status = self.image_processor.process_detection_data(processed_data)
-                    if img is not None:
-                        processed_placeholder.image(
-                            img, 
-                            caption="Latest Detection", 
-                            use_container_width=True
-                        )
-                        processed_status.success(f"📊 {status}")
-                        self.display_detection_info(processed_data)
-                    else:
-                        processed_placeholder.info("📷 No processed image available")
-                        processed_status.info("⏳ No processed images")
-                else:
-                    processed_placeholder.info("📷 No detection data available")
-                    processed_status.info("� Send detection data to Flask server")
-                
-                # Display raw images
-                if raw_data and raw_data.get('raw_image', False):
-                    raw_img, raw_status_msg = self.image_processor.process_detection_data(raw_data)
-                    if raw_img is not None:
-                        raw_placeholder.image(
-                            raw_img, 
-                            caption="Raw Camera Feed", 
-                            use_container_width=True
-                        )
-                        raw_status.success(f"📸 {raw_status_msg}")
-                        # Display raw info in sidebar when we have raw data
-                        self.display_detection_info(raw_data)
-                    else:
-                        raw_placeholder.info("📷 No raw image available")
-                        raw_status.info("⏳ No raw images")
-                else:
-                    raw_placeholder.info("📷 No raw images available")
-                    raw_status.info("💡 Type 'raw' in Pi script to enable raw mode")
+                self.show_processed(self.fetch_detection_data(), processed_placeholder, processed_status)
+                self.show_raw(self.fetch_raw_data(), raw_placeholder, raw_status)
             else:
                 st.warning("⚠️ Please ensure Flask server is running and try refreshing the page")
 
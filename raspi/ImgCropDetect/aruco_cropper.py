@@ -37,10 +37,12 @@ class ArucoCropper:
         """Captureaza un singur cadru de la camera."""
         return self.picam2.capture_array()
 
-    def get_cropped_image(self, frame):
+    def get_cropped_image(self, frame, out=None):
         """
         Detecteaza cele 4 markere ArUco si returneaza o imagine decupata,
         corectata din perspectiva, a regiunii interioare.
+        :param out: Buffer optional in care se scrie rezultatul; e refolosit
+                    doar daca are deja dimensiunea decupajului.
         Returneaza np.array sau None.
         """
         gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
@@ -88,7 +90,9 @@ class ArucoCropper:
 
         dst = np.array([[0,0], [W-1,0], [W-1,H-1], [0,H-1]], dtype="float32")
         M = cv2.getPerspectiveTransform(src, dst)
-        warped = cv2.warpPerspective(frame, M, (W, H))
+        if out is not None and out.shape != (H, W) + frame.shape[2:]:
+            out = None  # Dimensiune diferita - OpenCV aloca unul nou
+        warped = cv2.warpPerspective(frame, M, (W, H), dst=out)
         return warped
 
     def get_aruco_inner_corners_px(self):
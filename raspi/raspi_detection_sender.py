@@ -1,121 +1,488 @@
 # pi_sender.py - Modified to send raw images
 import asyncio
-import base64
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import cv2
+import numpy as np
+import os
 import time
+import uuid
+import queue
+import selectors
+import sys
 import threading
+import traceback
+from concurrent.futures import Future
+import torch
 from ultralytics import YOLO
 from ImgCropDetect.aruco_cropper import ArucoCropper
 
+try:
+    # libjpeg-turbo: SIMD color conversion + DCT, much faster than cv2.imencode on the Pi
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    turbo_jpeg = TurboJPEG()
+except Exception:  # Missing package or native library
+    turbo_jpeg = None
+
+try:
+    # C JSON encoder that returns bytes, ready to go into the multipart body
+    from orjson import dumps as dumps_json
+except ImportError:
+    def dumps_json(obj):
+        return json.dumps(obj).encode()
+
 API_URL = "http://172.16.55.12:5003/data"  # your laptop's IP!
 
-# Global variable to control what to send
-send_raw_mode = False
+# One keep-alive connection pool for all uploads instead of a new TCP connection per frame
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+
+# Set while raw frames are sent instead of detections (toggled by the 'raw' command)
+send_raw_mode = threading.Event()
+
+# Set when a capture/sender thread died, so main() stops instead of idling forever
+stage_failed = threading.Event()
+
+# JPEG quality for uploaded frames
+JPEG_QUALITY = 85
+
+# Upper bound on the capture rate; the camera or the pipeline may be slower
+CAPTURE_FPS = 30
+
+# Max frames waiting between pipeline stages (capture -> inference -> send)
+QUEUE_SIZE = 2
+# Max cropped frames run through YOLO in one call (whatever is already queued)
+INFER_BATCH_MAX = 4
+# Reusable crop buffers: both queues full + one frame each in capture and
+# sender + a full inference batch
+POOL_SIZE = 2 * QUEUE_SIZE + 2 + INFER_BATCH_MAX
+
+# Fixed YOLO input size, so the predictor never has to re-derive it per frame
+IMGSZ = 640
+
+def cpu_set_from_env(name):
+    """Parse a comma-separated CPU list like "2,3" from the environment (None if unset)."""
+    value = os.environ.get(name, "").strip()
+    return {int(cpu) for cpu in value.split(",")} if value else None
+
+# Optional CPU pinning, off by default: e.g. COMPUTE_CPUS=2,3 IO_CPUS=0,1 to give
+# inference its own cores. Only worth it if measured faster on the target board
+COMPUTE_CPUS = cpu_set_from_env("COMPUTE_CPUS")
+IO_CPUS = cpu_set_from_env("IO_CPUS")
+
+# Longest the inference loop waits for a frame before checking stdin for commands
+COMMAND_POLL_S = 0.1
+
+# Upload bodies are streamed to the socket in slices of this size
+UPLOAD_CHUNK = 64 * 1024
+
+# Processed frames are coalesced into one request: up to this many...
+BATCH_MAX = 4
+# ...or whatever arrived within this window after the first one
+BATCH_MAX_WAIT_MS = 200
+# Encoded frames allowed to wait for upload; older ones are dropped past this
+BATCH_QUEUE_SIZE = BATCH_MAX * 2
+
+def pin_current_thread(cpus):
+    """Restrict the calling thread to the given CPUs, where the OS supports it.
+
+    Does nothing if ``cpus`` is None (pinning not configured).
+    """
+    if not cpus or not hasattr(os, "sched_setaffinity"):
+        return
+    try:
+        os.sched_setaffinity(0, cpus)  # 0 = the calling thread on Linux
+    except OSError as e:
+        print(f"⚠️ Could not pin thread to CPUs {sorted(cpus)}: {e}")
+
+def encode_jpeg(image):
+    """Encode a BGR frame to JPEG bytes (TurboJPEG if available, else OpenCV)."""
+    if turbo_jpeg is not None:
+        return turbo_jpeg.encode(image, quality=JPEG_QUALITY, pixel_format=TJPF_BGR)
+    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    return buffer.tobytes()
+
+class MultipartBody:
+    """multipart/form-data body streamed in UPLOAD_CHUNK slices.
+
+    Takes the same {name: (filename, data, content_type)} mapping as
+    ``requests``' ``files=``, but yields memoryview slices of each part
+    instead of concatenating everything into one more copy of the JPEG.
+    Defining ``__len__`` lets ``requests`` send a Content-Length rather
+    than falling back to chunked transfer encoding.
+    """
+
+    def __init__(self, fields):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        self._parts = []
+        for name, (filename, data, part_type) in fields.items():
+            disposition = f'form-data; name="{name}"'
+            if filename:
+                disposition += f'; filename="{filename}"'
+            head = (f"--{boundary}\r\nContent-Disposition: {disposition}\r\n"
+                    f"Content-Type: {part_type}\r\n\r\n").encode()
+            if isinstance(data, str):
+                data = data.encode()
+            self._parts.append((head, data))
+        self._tail = f"--{boundary}--\r\n".encode()
+
+    def __len__(self):
+        return sum(len(head) + len(data) + 2 for head, data in self._parts) + len(self._tail)
+
+    def __iter__(self):
+        for head, data in self._parts:
+            yield head
+            view = memoryview(data)
+            for start in range(0, len(view), UPLOAD_CHUNK):
+                yield view[start:start + UPLOAD_CHUNK]
+            yield b"\r\n"
+        yield self._tail
 
-def encode_image_to_base64(image):
-    _, buffer = cv2.imencode('.jpg', image)
-    return base64.b64encode(buffer).decode('utf-8')
+def post_multipart(files):
+    """POST multipart parts to the API and return the decoded JSON reply."""
+    body = MultipartBody(files)
+    response = session.post(API_URL, data=body, headers={"Content-Type": body.content_type}, timeout=3)
+    response.raise_for_status()
+    return response.json()
 
-def send_image_data(image, detections, is_raw=False):
+class FrameDropped(Exception):
+    """Set on a frame's Future when newer frames pushed it out of the upload queue."""
+
+class FrameBatcher:
+    """Coalesces processed frames into one multipart request per batch."""
+
+    def __init__(self, max_batch=BATCH_MAX, max_wait_ms=BATCH_MAX_WAIT_MS):
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        # Bounded like the pipeline queues, so a slow link can't pile up stale frames
+        self._q = queue.Queue(BATCH_QUEUE_SIZE)
+        threading.Thread(target=self._run, name="batcher", daemon=True).start()
+
+    def submit(self, jpeg_bytes, meta):
+        """Queue a frame without blocking; the Future resolves to the server reply.
+
+        If uploads fall behind, the oldest waiting frame is dropped and its
+        Future fails with FrameDropped.
+        """
+        future = Future()
+        put_latest(self._q, (jpeg_bytes, meta, future),
+                   lambda item: item[2].set_exception(FrameDropped("superseded by newer frames")))
+        return future
+
+    def _run(self):
+        pin_current_thread(IO_CPUS)
+        while True:
+            batch = [self._q.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._post(batch)
+
+    def _post(self, batch):
+        # Fields image_0..image_{n-1} plus one meta JSON array in the same order
+        files = {
+            f"image_{i}": (f"frame_{i}.jpg", jpeg_bytes, "image/jpeg")
+            for i, (jpeg_bytes, _, _) in enumerate(batch)
+        }
+        files["meta"] = (None, dumps_json([meta for _, meta, _ in batch]), "application/json")
+        try:
+            result = post_multipart(files)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for _, _, future in batch:
+            future.set_result(result)
+
+def report_send(future, w, h, count, is_raw):
+    """Print the outcome of an upload once the server answered."""
+    try:
+        result = future.result()
+    except FrameDropped:
+        print("⏭️ Dropped stale frame, uploads are falling behind")
+        return
+    except requests.exceptions.HTTPError as e:
+        print(f"❌ Send failed: {e.response.status_code}")
+        return
+    except Exception as e:
+        print("❌ Failed to send:", e)
+        return
+    status = result.get('status', 'unknown')
+    img_type = "RAW" if is_raw else "PROCESSED"
+    print(f"📤 Sent {img_type} frame {w}x{h} with {count} detections - BLE Status: {status}")
+
+def send_image_data(batcher, image, detections, is_raw=False):
     # Get image dimensions for crop_shape
     h, w = image.shape[:2]  # height, width from image shape
     
-    payload = {
-        "image": encode_image_to_base64(image),
-        "timestamp": time.strftime("%Y%m%d_%H%M%S"),
+    meta = {
+        "timestamp": time.time_ns(),  # Integer epoch ns, no localtime()/strftime per frame
         "detections": detections if not is_raw else [],
         "crop_shape": [w, h],  # OBLIGATORIU: [width, height]
         "raw_image": is_raw  # Flag to indicate raw image
     }
+    # The JPEG is a copy, so the caller may reuse the frame buffer right after this
+    jpeg_bytes = encode_jpeg(image)
+    
+    if is_raw:
+        # Raw frames are large and latency-sensitive: send right away, unbatched.
+        # The JPEG goes as a raw binary part, no base64 (+33%) or JSON escaping
+        files = {
+            "image": ("frame.jpg", jpeg_bytes, "image/jpeg"),
+            "meta": (None, dumps_json(meta), "application/json"),
+        }
+        future = Future()
+        try:
+            future.set_result(post_multipart(files))
+        except Exception as e:
+            future.set_exception(e)
+    else:
+        future = batcher.submit(jpeg_bytes, meta)
     
+    future.add_done_callback(lambda f: report_send(f, w, h, len(detections), is_raw))
+
+class StdinCommands:
+    """Non-blocking reader for commands typed on stdin, one per line."""
+
+    def __init__(self):
+        self._sel = selectors.DefaultSelector()
+        self._pending = b""
+        try:
+            self._fd = sys.stdin.fileno()
+            self._sel.register(self._fd, selectors.EVENT_READ)
+        except (AttributeError, ValueError, OSError) as e:
+            # epoll can't watch regular files or /dev/null (systemd, nohup, < file)
+            print(f"⚠️ stdin can't be polled, running without commands: {e}")
+            self._fd = None
+
+    def poll(self):
+        """Return the complete lines typed since the last call."""
+        if self._fd is None:
+            return []
+        # Read the fd directly: a TextIOWrapper could keep a second line in its
+        # own buffer where select() can't see it
+        while self._sel.select(0):
+            data = os.read(self._fd, 4096)
+            if not data:
+                # stdin closed: keep the last partial line, stop watching it
+                self._pending += b"\n"
+                self._sel.unregister(self._fd)
+                self._fd = None
+                break
+            self._pending += data
+        *lines, self._pending = self._pending.split(b"\n")
+        return [line.decode(errors="replace").strip().lower() for line in lines]
+
+def poll_commands(commands):
+    """Handle commands already typed on stdin without blocking.
+
+    Returns False once 'quit' was entered.
+    """
+    for cmd in commands.poll():
+        if cmd == 'raw':
+            if send_raw_mode.is_set():
+                send_raw_mode.clear()
+            else:
+                send_raw_mode.set()
+            mode = "RAW" if send_raw_mode.is_set() else "PROCESSED"
+            print(f"📸 Switched to {mode} mode")
+        elif cmd == 'quit':
+            print("🛑 Exiting...")
+            return False
+    return True
+
+class FramePool:
+    """Fixed set of crop buffers passed between stages by index and reused."""
+
+    def __init__(self, size):
+        self.buffers = [None] * size
+        self._free = queue.Queue()
+        for idx in range(size):
+            self._free.put(idx)
+
+    def acquire(self):
+        """Block until a buffer is free (back-pressure) and return its index."""
+        return self._free.get()
+
+    def release(self, idx):
+        """Hand a buffer back once its frame has been sent or dropped."""
+        if idx is not None:
+            self._free.put(idx)
+
+def run_stage(stage, *args):
+    """Thread target for a pipeline stage: if it crashes, log why and stop main()."""
     try:
-        response = requests.post(API_URL, json=payload, timeout=3)
-        if response.status_code == 200:
-            result = response.json()
-            status = result.get('status', 'unknown')
-            img_type = "RAW" if is_raw else "PROCESSED"
-            print(f"📤 Sent {img_type} frame {w}x{h} with {len(detections)} detections - BLE Status: {status}")
+        stage(*args)
+    except Exception:
+        traceback.print_exc()
+        print(f"❌ {threading.current_thread().name} thread crashed, stopping")
+        stage_failed.set()
+
+def put_latest(q, item, on_drop=None):
+    """Put item on a bounded queue, dropping the oldest one if the consumer fell behind."""
+    while True:
+        try:
+            q.put_nowait(item)
+            return
+        except queue.Full:
+            try:
+                dropped = q.get_nowait()
+            except queue.Empty:
+                continue
+            if on_drop:
+                on_drop(dropped)
+
+def capture_loop(cropper, pool, capture_q, send_q):
+    """Stage 1: grab frames and crop them; raw frames skip inference."""
+    pin_current_thread(IO_CPUS)
+    period = 1 / CAPTURE_FPS
+    next_t = time.monotonic()
+    while True:
+        # Sleep only for whatever is left of this frame's period
+        slack = next_t - time.monotonic()
+        if slack > 0:
+            time.sleep(slack)
         else:
-            print(f"❌ Send failed: {response.status_code}")
-    except Exception as e:
-        print("❌ Failed to send:", e)
+            next_t = time.monotonic()  # Running behind: don't try to catch up
+        next_t += period
+        
+        frame = cropper.capture_frame()
+        
+        if send_raw_mode.is_set():
+            # Send raw frame without processing (fresh array from the camera, no pool slot)
+            if frame is not None:
+                put_latest(send_q, (None, frame, [], True), lambda item: pool.release(item[0]))
+        else:
+            # Normal detection mode - warp straight into a pooled buffer
+            idx = pool.acquire()
+            cropped = cropper.get_cropped_image(frame, out=pool.buffers[idx])
+            
+            if cropped is None:
+                pool.release(idx)
+                continue
+            
+            # Keep the buffer if its size changed, so the next crop reuses it
+            pool.buffers[idx] = cropped
+            put_latest(capture_q, idx, pool.release)
+
+def postprocess(result, h, id_mask, id_names):
+    """Turn one YOLO result into detection dicts for the target classes.
 
-def command_listener():
-    """Listen for commands to toggle raw image mode."""
-    global send_raw_mode
-    print("🎮 Command listener started! Type 'raw' to toggle raw image mode, 'quit' to exit")
+    ``id_mask`` is a bool tensor indexed by class id (True for target
+    classes) and ``id_names`` the class names indexed the same way.
+
+    Filtering, box centers and the y flip run as tensor ops on the whole
+    batch of boxes; a single .tolist() then copies everything off the
+    device at once instead of one .item() sync per box.
+    """
+    boxes = result.boxes
+    cls = boxes.cls.to(torch.int64)
+    keep = id_mask.to(cls.device)[cls]
+    # FP32 before any math: FP16 boxes (half=True on CUDA) only resolve 2 px
+    # steps above 2048 px, and these pixel coordinates go to the arm
+    xyxy = boxes.xyxy[keep].float()
+    centers = (xyxy[:, :2] + xyxy[:, 2:]) * 0.5
+    centers[:, 1] = h - centers[:, 1]  # Note: h - cy for coordinate flip
+    conf = boxes.conf[keep].float()
+    rows = torch.cat((boxes.cls[keep].float().unsqueeze(1), conf.unsqueeze(1), centers), dim=1).tolist()
     
+    return [
+        {'class': id_names[int(c)], 'confidence': conf, 'center_px': [cx, cy]}
+        for c, conf, cx, cy in rows
+    ]
+
+def sender_loop(pool, send_q, batcher):
+    """Stage 3: JPEG-encode and POST frames so uploads overlap inference."""
+    pin_current_thread(IO_CPUS)
     while True:
+        idx, image, dets, is_raw = send_q.get()
+        if is_raw:
+            h, w, _ = image.shape
+            print(f"📷 Sending RAW frame: {w}x{h}")
         try:
-            cmd = input().strip().lower()
-            if cmd == 'raw':
-                send_raw_mode = not send_raw_mode
-                mode = "RAW" if send_raw_mode else "PROCESSED"
-                print(f"📸 Switched to {mode} mode")
-            elif cmd == 'quit':
-                print("🛑 Exiting...")
-                break
-        except (EOFError, KeyboardInterrupt):
-            break
+            send_image_data(batcher, image, dets, is_raw=is_raw)
+        finally:
+            pool.release(idx)
+
 def main():
     cropper = ArucoCropper(camera_resolution=(4608, 2592), reference_ids=[0,1,2,3])
+    # Pin before torch starts its worker threads so they inherit the CPU set
+    pin_current_thread(COMPUTE_CPUS)
     model = YOLO("ModelV3.4.pt")
+    model.fuse()  # Fold BatchNorm into the convolutions once
+    # FP16 on a CUDA GPU if there is one; the Pi CPU stays on FP32
+    device = 0 if torch.cuda.is_available() else 'cpu'
+    predict_args = dict(imgsz=IMGSZ, device=device, half=device != 'cpu', verbose=False)
+    # Pay for predictor setup / kernel selection now instead of on the first real frame
+    with torch.inference_mode():
+        for _ in range(2):
+            model.predict(np.zeros((IMGSZ, IMGSZ, 3), np.uint8), **predict_args)
     target = ['triangle', 'rectangle', 'arch', 'cube']
     ids = [i for i, n in model.names.items() if n in target]
+    # Class id -> is-target flag and -> name, as O(1) lookups for post-processing
+    id_mask = torch.zeros(len(model.names), dtype=torch.bool)
+    id_mask[ids] = True
+    id_mask = id_mask.to(device)
+    id_names = tuple(model.names[i] for i in range(len(model.names)))
     
     print("Starting detection with raw image support...")
-    print("Type 'raw' to toggle raw image mode")
+    print("🎮 Type 'raw' to toggle raw image mode, 'quit' to exit")
     
-    # Start command listener in background thread
-    cmd_thread = threading.Thread(target=command_listener, daemon=True)
-    cmd_thread.start()
+    # Commands are read from stdin by this loop itself, no listener thread
+    commands = StdinCommands()
     
-    while True:
-        frame = cropper.capture_frame()
+    # Capture and upload run in their own threads; inference stays on this one
+    # Only buffer indices travel through the queues; the frames stay in the pool
+    pool = FramePool(POOL_SIZE)
+    capture_q = queue.Queue(QUEUE_SIZE)
+    send_q = queue.Queue(QUEUE_SIZE)
+    batcher = FrameBatcher()
+    threading.Thread(target=run_stage, args=(capture_loop, cropper, pool, capture_q, send_q),
+                     name="capture", daemon=True).start()
+    threading.Thread(target=run_stage, args=(sender_loop, pool, send_q, batcher),
+                     name="sender", daemon=True).start()
+    
+    while not stage_failed.is_set() and poll_commands(commands):
+        # Stage 2: inference on the next cropped frame...
+        try:
+            batch = [capture_q.get(timeout=COMMAND_POLL_S)]
+        except queue.Empty:
+            continue  # Raw mode or slow camera: go check for commands again
+        # ...plus any others already waiting, in a single model call
+        while len(batch) < INFER_BATCH_MAX:
+            try:
+                batch.append(capture_q.get_nowait())
+            except queue.Empty:
+                break
+        frames = [pool.buffers[idx] for idx in batch]
         
-        if send_raw_mode:
-            # Send raw frame without processing
-            if frame is not None:
-                h, w, _ = frame.shape
-                print(f"📷 Sending RAW frame: {w}x{h}")
-                send_image_data(frame, [], is_raw=True)
-        else:
-            # Normal detection mode
-            cropped = cropper.get_cropped_image(frame)
-            
-            if cropped is None:
-                continue
-            
+        for cropped in frames:
             h, w, _ = cropped.shape
             print(f"📷 Processing frame: {w}x{h}")
-            
-            res = model(cropped, verbose=False)
-            dets = []
-            
-            for box in res[0].boxes:
-                c = int(box.cls.item())
-                if c not in ids:
-                    continue
-                    
-                x1, y1, x2, y2 = box.xyxy[0].tolist()
-                cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
-                
-                dets.append({
-                    'class': model.names[c],
-                    'confidence': float(box.conf.item()),
-                    'center_px': [cx, h - cy]  # Note: h - cy for coordinate flip
-                })
+        
+        with torch.inference_mode():
+            results = model.predict(frames, **predict_args)
+        
+        for idx, cropped, res in zip(batch, frames, results):
+            dets = postprocess(res, cropped.shape[0], id_mask, id_names)
             
             if dets:
                 print(f"🎯 Found {len(dets)} detections:")
                 for det in dets:
                     print(f"   {det['class']}: {det['confidence']:.3f} at ({det['center_px'][0]:.0f}, {det['center_px'][1]:.0f})")
             
-            send_image_data(cropped, dets)
-        
-        time.sleep(0.1)
+            put_latest(send_q, (idx, cropped, dets, False), lambda item: pool.release(item[0]))
+    
+    if stage_failed.is_set():
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()